@@ -5,17 +5,29 @@ __author__ = "Micah Smith"
 __email__ = "micahjsmith@gmail.com"
 __version__ = "2.0.2"
 
+import random
+import sys
+import threading
 import time
 import types
 from collections import defaultdict
-from functools import wraps
+from functools import partial, wraps
 from inspect import getfullargspec
 from typing import Any, Callable, TypeVar
 
-from ._time_formatters import format_time
+from ._context import Entry, active_blocks, current_block
+from ._executors import StacklogExecutor, bind
+from ._profiling import make_profiler, write_profile
+from ._registry import DEFAULT_SETTINGS, Registry, Settings, registry, with_level
+from ._scheduler import scheduler
+from ._time_formatters import format_time, parse_time
 from .compat import Dict, List, ParamSpec, StrEnum, Tuple, Union
 
 __all__ = (
+    "Registry",
+    "Settings",
+    "StacklogExecutor",
+    "registry",
     "stacklog",
     "stacktime",
 )
@@ -54,11 +66,24 @@ StacklogCallbackFn = Callable[["stacklog"], None]
 P_CALL = ParamSpec("P_CALL")
 T_CALL = TypeVar("T_CALL")
 
+# guards held-back begin lines, which the scheduler may release from its thread
+_held_lock = threading.RLock()
+
 
 def getnargs(func: object) -> int:
     return len(getfullargspec(func).args)
 
 
+def get_caller_module() -> str:
+    """Return the name of the first module outside stacklog on the call stack"""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get("__name__") == __name__:
+        frame = frame.f_back  # type: ignore
+    if frame is None:
+        return ""
+    return frame.f_globals.get("__name__", "")
+
+
 class Event(StrEnum):
     ENTER = "enter"
     BEGIN = "begin"
@@ -91,6 +116,31 @@ class stacklog:
         INFO:root:Skipping not implemented...
         INFO:root:Skipping not implemented...SKIPPED
 
+    With ``defer``, the begin line is held back and, for blocks that finish
+    quickly, only the end line is written::
+
+       with stacklog(logging.info, 'Running short function', defer=1.0):
+           run_short_function()
+
+    This produces logging output::
+
+        INFO:root:Running short function...DONE
+
+    The held-back begin line is still written as soon as the block has been
+    open for ``defer`` seconds (from a shared background thread) or when any
+    other block logs while this one is open, so that nested output stays
+    readable.
+
+    Blocks can be tuned or disabled at runtime through the settings
+    :data:`registry`, keyed by message and module::
+
+       registry.configure('Running short*', enabled=False)
+
+    Work submitted to other threads or processes from within a block can be
+    carried into the block with :meth:`bind` or :class:`StacklogExecutor`.
+    The time spent on it is accumulated in ``fanout_seconds``, and blocks
+    opened in worker threads record the block as their ``parent``.
+
     Args:
         method: log callable
         message: log message
@@ -98,6 +148,9 @@ class stacklog:
         conditions (List[Tuple]): list of tuples of exceptions or tuple of
             exceptions to catch and log conditions, such as
             ``[(NotImplementedError, 'SKIPPED')]``.
+        defer (float): if given, hold back the begin line and only write it
+            if the block is still open after this many seconds or if another
+            block logs in the meantime. Defaults to None (never hold back).
         **kwargs: kwargs to log method
     """
 
@@ -111,6 +164,7 @@ class stacklog:
         message: str,
         *args,  # type: ignore
         conditions: Union[List[Tuple[type, str]], None] = None,
+        defer: Union[float, None] = None,
         **kwargs  # type: ignore
     ):
         if conditions is None:
@@ -119,6 +173,13 @@ class stacklog:
         self.message = str(message)
         self.args = args  # type: ignore
         self.kwargs = kwargs  # type: ignore
+        self.defer = defer
+        self.module = get_caller_module()
+        self.settings: Settings = DEFAULT_SETTINGS
+
+        self.__last_entry: Union[Entry, None] = None
+        self.__settings_version = -1
+        self.__base_method: Union[StacklogMethodFn, None] = None
 
         self.__callbacks = defaultdict(list)
         self.__conditions = []
@@ -132,10 +193,97 @@ class stacklog:
         for exc_type, suffix in conditions:
             self.on_condition(match_condition(exc_type), log_condition(suffix))
 
+    @property
+    def wall_seconds(self) -> float:
+        """Seconds spent in the block so far, or in total once it has exited"""
+        entry = self.__entry()
+        if entry is None or entry.entered_at is None:
+            return 0
+        elif entry.exited_at is None:
+            return time.perf_counter() - entry.entered_at
+        else:
+            return entry.exited_at - entry.entered_at
+
+    @property
+    def entry(self) -> Union[Entry, None]:
+        """The execution of this block that is open in this context, or else its last one"""
+        return self.__entry()
+
+    @property
+    def parent(self) -> Union["stacklog", None]:
+        """The block that this block was opened in, if any"""
+        entry = self.__entry()
+        return entry.parent if entry is not None else None
+
+    bind = staticmethod(bind)
+    current = staticmethod(current_block)
+
+    @property
+    def fanout_seconds(self) -> float:
+        """Seconds spent on behalf of the block by other threads or processes"""
+        entry = self.__entry()
+        return entry.fanout_seconds if entry is not None else 0.0
+
+    def add_fanout(self, seconds: float) -> None:
+        """Add time spent on behalf of this block by other threads or processes
+
+        The time is ignored if the block is not open in this context.
+        """
+        entry = self.__open_entry()
+        if entry is not None:
+            entry.add_fanout(seconds)
+
     def log(self, suffix: str = "") -> None:
         """Log a message with given suffix"""
+        entry = self.__entry()
+        if entry is not None and entry.holding:
+            entry.held.append(suffix)
+            return
+
+        self.__release_enclosing(entry)
+        if entry is not None and entry.held:
+            with _held_lock:
+                if entry.exiting and not self.__is_overdue(entry):
+                    # the end line replaces the begin line
+                    entry.held.clear()
+                else:
+                    self.__release(entry)
+
+        self.__emit(suffix)
+
+    def __open_entry(self) -> Union[Entry, None]:
+        """Return the innermost entry of this block that is open in this context"""
+        for entry in reversed(active_blocks.get()):
+            if entry.block is self:
+                return entry
+        return None
+
+    def __entry(self) -> Union[Entry, None]:
+        """Return the open entry of this block, or else its last entry"""
+        entry = self.__open_entry()
+        return entry if entry is not None else self.__last_entry
+
+    def __emit(self, suffix: str) -> None:
         self.method(self.message + "..." + suffix, *self.args, **self.kwargs)  # type: ignore
 
+    def __release(self, entry: Entry) -> None:
+        with _held_lock:
+            held, entry.held = entry.held, []
+            for suffix in held:
+                self.__emit(suffix)
+
+    def __release_enclosing(self, entry: Union[Entry, None]) -> None:
+        for other in active_blocks.get():
+            if other is entry:
+                break
+            if other.held:
+                other.block.__release(other)
+
+    def __is_overdue(self, entry: Entry) -> bool:
+        if self.defer is None or entry.entered_at is None:
+            return True
+        return time.perf_counter() - entry.entered_at >= self.defer
+
     def on_begin(self, func: StacklogCallbackFn) -> None:
         """Add callback for beginning of block
 
@@ -220,32 +368,108 @@ class stacklog:
             func = self.__conditions[self.__condition_index][1]
             call_with_args(func, self, exc_type, exc_val, exc_tb)
 
+    def __apply_settings(self) -> None:
+        self.__settings_version = registry.version
+        self.settings = registry.lookup(self.message, self.module)
+        if self.settings.level is not None:
+            if self.__base_method is None:
+                self.__base_method = self.method
+            self.method = with_level(self.__base_method, self.settings.level)
+        elif self.__base_method is not None:
+            self.method, self.__base_method = self.__base_method, None
+
     def __call__(self, func: Callable[P_CALL, T_CALL]) -> Callable[P_CALL, T_CALL]:
         @wraps(func)
         def wrapper(*args: P_CALL.args, **kwargs: P_CALL.kwargs):
+            if self.__settings_version == registry.version and not self.settings.enabled:
+                return func(*args, **kwargs)
             with self:
                 return func(*args, **kwargs)
 
         return wrapper
 
     def __enter__(self):
+        if self.__settings_version != registry.version:
+            self.__apply_settings()
+        if not self.settings.enabled:
+            # push nothing, so that disabled blocks stay cheap. __exit__ can
+            # then tell that nothing was pushed, unless this block's own entry
+            # is on top, so mark that one.
+            stack = active_blocks.get()
+            if stack and stack[-1].block is self:
+                stack[-1].skipped += 1
+            return self
+
+        sample = self.settings.sample
+        active = sample >= 1 or random.random() < sample
+
+        # push an entry even if sampled out, so that __exit__ pops the right one
+        entry = Entry(self, active, current_block() if active else None)
+        active_blocks.set(active_blocks.get() + (entry,))
+        if not active:
+            return self
+
+        self.__last_entry = entry
         self.__signal(Event.ENTER)
-        self.__signal(Event.BEGIN)
+
+        entry.entered_at = time.perf_counter()
+        entry.holding = self.defer is not None
+        try:
+            self.__signal(Event.BEGIN)
+        finally:
+            entry.holding = False
+        if entry.held:
+            deadline = entry.entered_at + self.defer  # type: ignore
+            entry.release = scheduler.schedule(deadline, partial(self.__release, entry))
+
         return self
 
     def __exit__(self, *sys_exc_info: SysExcInfo):
-        exc_type, exc_val, exc_tb = sys_exc_info
-        self.__signal(Event.EXIT)
+        # blocks are properly nested, so the entry pushed by the matching
+        # __enter__, if any, is on top
+        stack = active_blocks.get()
+        if not stack or stack[-1].block is not self:
+            return False
+        entry = stack[-1]
+        if entry.skipped:
+            entry.skipped -= 1
+            return False
 
-        if exc_type is None:  # type: ignore
-            self.__signal(Event.SUCCESS)
-        elif self.__matches_exception(exc_type, exc_val, exc_tb):
-            self.__handle_exception(exc_type, exc_val, exc_tb)
-        else:
-            self.__signal(Event.FAILURE)
+        try:
+            if entry.active:
+                self.__finish(entry, *sys_exc_info)
+        finally:
+            stack = active_blocks.get()
+            if stack and stack[-1] is entry:
+                active_blocks.set(stack[:-1])
+            else:
+                active_blocks.set(tuple(e for e in stack if e is not entry))
 
         return False
 
+    def __finish(self, entry: Entry, *sys_exc_info: SysExcInfo):
+        exc_type, exc_val, exc_tb = sys_exc_info
+        entry.exited_at = time.perf_counter()
+        entry.exiting = True
+        try:
+            self.__signal(Event.EXIT)
+
+            if exc_type is None:  # type: ignore
+                self.__signal(Event.SUCCESS)
+            elif self.__matches_exception(exc_type, exc_val, exc_tb):
+                self.__handle_exception(exc_type, exc_val, exc_tb)
+            else:
+                self.__signal(Event.FAILURE)
+
+            # nothing was logged at exit, so don't lose the begin line
+            if entry.held:
+                self.__release(entry)
+        finally:
+            entry.exiting = False
+            if entry.release is not None:
+                scheduler.cancel(entry.release)
+                entry.release = None
+
 
 P_CALL_WITH_ARGS = ParamSpec("P_CALL_WITH_ARGS")
 T_CALL_WITH_ARGS = TypeVar("T_CALL_WITH_ARGS")
@@ -267,7 +491,11 @@ def begin(stacklogger: stacklog) -> None:
 
 def succeed(stacklogger: stacklog) -> None:
     """Log the default success message"""
-    stacklogger.log(suffix=SUCCESS)
+    suffix = SUCCESS
+    if stacklogger.settings.timing:
+        unit = stacklogger.settings.unit or "auto"
+        suffix += " in " + format_time(unit, stacklogger.wall_seconds)
+    stacklogger.log(suffix=suffix)
 
 
 def fail(stacklogger: stacklog) -> None:
@@ -301,11 +529,27 @@ def log_condition(suffix: str) -> StacklogCallbackFn:
 class stacktime(stacklog):
     """Stack log messages with timing information
 
-    The same arguments apply as to stacklog, with one additional kwarg.
+    The same arguments apply as to stacklog, with some additional kwargs.
 
     Args:
         unit (str):
             one of 'auto', 'ns', 'mks', 'ms', 's', 'min'. Defaults to 'auto'.
+        profile (float):
+            if given, profile the block while it runs and write the profile
+            to ``profile_dir`` if the block takes at least this many seconds.
+            Defaults to None (no profiling).
+        profile_dir (str):
+            directory to write profiles to, which is created if needed.
+            Defaults to the current directory.
+        profile_format (str):
+            one of 'collapsed' (collapsed stacks sampled from a shared
+            background thread, for flame graphs) or 'pstats' (deterministic
+            profile with cProfile, which slows the block down, for blocks
+            that are already suspect). Defaults to 'collapsed'.
+        budget (float or str):
+            the time the block is expected to take at most, either in seconds
+            or as a string such as ``'50ms'``. Blocks that take longer are
+            reported as over budget. Defaults to None (no budget).
 
     Example usage::
 
@@ -315,14 +559,46 @@ class stacktime(stacklog):
        Running some code...
        Running some code...DONE in 11.11 ms
 
+    Profiling slow blocks::
+
+       >>> with stacktime(print, 'Running some code', profile=1.0):
+       ...     time.sleep(2)
+       ...
+       Running some code...
+       Running some code...DONE in 2.00 s (profile: ./Running_some_code-...collapsed)
+
+    Enforcing a time budget::
+
+       >>> with stacktime(print, 'Running some code', budget='5ms'):
+       ...     time.sleep(1e-2)
+       ...
+       Running some code...
+       Running some code...DONE in 10.12 ms (over budget of 5.00 ms)
+
     """
 
+    # callables that are passed each stacktime instance as its block exits,
+    # such as the collectors of the stacklog pytest plugin
+    observers: List[Callable[["stacktime"], None]] = []
+
     def __init__(
-        self, method: StacklogMethodFn, message: str, unit: str = "auto", **kwargs  # type: ignore
+        self,
+        method: StacklogMethodFn,
+        message: str,
+        unit: str = "auto",
+        profile: Union[float, None] = None,
+        profile_dir: str = ".",
+        profile_format: str = "collapsed",
+        budget: Union[float, str, None] = None,
+        **kwargs  # type: ignore
     ):
         super().__init__(method, message, **kwargs)  # type: ignore
 
         self.unit = unit
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.profile_format = profile_format
+        self.budget = parse_time(budget) if budget is not None else None
 
         self.start: Union[float, None] = None
         self.end: Union[float, None] = None
@@ -333,31 +609,73 @@ class stacktime(stacklog):
         def handle_exit(_s: stacklog):
             if self.start:
                 self.end = time.time()
+            for observer in stacktime.observers:
+                observer(self)
 
         def handle_success(_s: stacklog):
-            if self.start is not None and self.end is not None:
-                duration = self.__format_time(self.end - self.start)
-                suffix = SUCCESS + " in " + duration
-            else:
-                suffix = SUCCESS
-            _s.log(suffix=suffix)
+            suffix = SUCCESS + " in " + self.elapsed
+            if self.fanout_seconds:
+                suffix += " (fan-out " + self.__format_time(self.fanout_seconds) + ")"
+            if self.over_budget:
+                budget = self.__format_time(self.budget)  # type: ignore
+                suffix += " (over budget of " + budget + ")"
+            _s.log(suffix=suffix + self.__profile_suffix())
 
         self.on_enter(handle_enter)
         self.on_exit(handle_exit)
         self.on_success(handle_success)
 
+        if profile is not None:
+            self.__add_profiling()
+
+    def __add_profiling(self) -> None:
+        # each execution of the block has its own profiler, so that recursive
+        # or concurrent executions don't replace each other's profilers
+        def handle_enter(_s: stacklog):
+            entry = self.entry
+            entry.profiler = make_profiler(self.profile_format)  # type: ignore
+            entry.profiler.start()  # type: ignore
+
+        def handle_exit(_s: stacklog):
+            entry = self.entry
+            if entry is None or entry.profiler is None:
+                return
+            profiler, entry.profiler = entry.profiler, None
+            profiler.stop()
+            if profiler.running and self.elapsed_seconds >= self.profile:  # type: ignore
+                entry.profile_path = write_profile(profiler, self.profile_dir, self.message)
+
+        def handle_failure(_s: stacklog):
+            _s.log(suffix=FAILURE + self.__profile_suffix())
+
+        self.on_enter(handle_enter)
+        self.on_exit(handle_exit)
+        self.on_failure(handle_failure)
+
+    @property
+    def profile_path(self) -> Union[str, None]:
+        """Path of the profile written by the current or last execution, if any"""
+        entry = self.entry
+        return entry.profile_path if entry is not None else None
+
+    def __profile_suffix(self) -> str:
+        if self.profile_path is None:
+            return ""
+        return " (profile: " + self.profile_path + ")"
+
     def __format_time(self, secs: float) -> str:
-        return format_time(self.unit, secs)
+        return format_time(self.settings.unit or self.unit, secs)
 
     @property
     def elapsed_seconds(self) -> float:
-        now = time.time()
-        if self.start is None:
-            return 0
-        elif self.end is None:
-            return now - self.start
-        else:
-            return self.end - self.start
+        # timed per execution, unlike start and end, which recursive or
+        # concurrent executions of the same instance overwrite
+        return self.wall_seconds
+
+    @property
+    def over_budget(self) -> bool:
+        """Whether the block has taken longer than its budget"""
+        return self.budget is not None and self.elapsed_seconds > self.budget
 
     @property
     def elapsed(self) -> str:
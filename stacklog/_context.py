@@ -0,0 +1,74 @@
+import threading
+from contextvars import ContextVar
+from typing import Any
+
+from .compat import List, Tuple, Union
+
+# guards the fan-out time of entries, which workers may add to concurrently
+_fanout_lock = threading.Lock()
+
+
+class Entry:
+    """One execution of a block
+
+    A block can be entered several times at once, such as a decorated
+    function that recurses or runs in several threads, so the state of each
+    execution is kept here rather than on the block itself.
+    """
+
+    __slots__ = (
+        "block",
+        "active",
+        "parent",
+        "entered_at",
+        "exited_at",
+        "held",
+        "holding",
+        "exiting",
+        "fanout_seconds",
+        "profiler",
+        "profile_path",
+        "release",
+        "skipped",
+    )
+
+    def __init__(self, block: Any, active: bool, parent: Any = None):
+        self.block = block
+        self.active = active
+        self.parent = parent
+        self.entered_at: Union[float, None] = None
+        self.exited_at: Union[float, None] = None
+        self.held: List[str] = []
+        self.holding = False
+        self.exiting = False
+        self.fanout_seconds = 0.0
+        self.profiler: Any = None
+        self.profile_path: Union[str, None] = None
+        # scheduled release of the held lines, if any
+        self.release: Any = None
+        # disabled executions of the same block nested directly in this one
+        self.skipped = 0
+
+    def add_fanout(self, seconds: float) -> None:
+        """Add time spent on behalf of this entry, unless it has already exited"""
+        with _fanout_lock:
+            if self.exited_at is None:
+                self.fanout_seconds += seconds
+
+
+# entries of the blocks that are currently open in this context, outermost first
+active_blocks: "ContextVar[Tuple[Entry, ...]]" = ContextVar("stacklog_active_blocks", default=())
+
+
+def current_entry() -> Union[Entry, None]:
+    """Return the innermost active entry in this context, or None"""
+    for entry in reversed(active_blocks.get()):
+        if entry.active:
+            return entry
+    return None
+
+
+def current_block() -> Any:
+    """Return the innermost block open in this context, or None"""
+    entry = current_entry()
+    return entry.block if entry is not None else None
@@ -0,0 +1,108 @@
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextvars import copy_context
+from functools import wraps
+from typing import Any, Callable, TypeVar
+
+from ._context import Entry, current_entry
+from .compat import ParamSpec, Tuple, Union
+
+P_BIND = ParamSpec("P_BIND")
+T_BIND = TypeVar("T_BIND")
+
+
+def bind(func: Callable[P_BIND, T_BIND]) -> Callable[P_BIND, T_BIND]:
+    """Bind ``func`` to the blocks that are open where it is bound
+
+    The returned function can be run in another thread, such as by a
+    ``ThreadPoolExecutor``. Blocks opened while it runs are nested in the
+    current block, and the time it takes to run is added to the fan-out time
+    of the current block, as long as that execution of the block is still open.
+    """
+    entry = current_entry()
+    context = copy_context()
+
+    @wraps(func)
+    def wrapper(*args: P_BIND.args, **kwargs: P_BIND.kwargs) -> T_BIND:
+        start = time.perf_counter()
+        try:
+            return context.copy().run(func, *args, **kwargs)
+        finally:
+            if entry is not None:
+                entry.add_fanout(time.perf_counter() - start)
+
+    return wrapper
+
+
+def timed_call(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Tuple[bool, Any, float]:
+    """Call ``func`` and return whether it succeeded, its result or exception, and its duration"""
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        return False, e, time.perf_counter() - start
+    return True, result, time.perf_counter() - start
+
+
+class TimedFuture(Future):
+    """Future for the result of a ``timed_call`` submitted to another executor"""
+
+    def __init__(self, inner: Future, entry: Union[Entry, None]):
+        super().__init__()
+        self.inner = inner
+        self.entry = entry
+        inner.add_done_callback(self.__resolve)
+
+    def cancel(self) -> bool:
+        return self.inner.cancel() and super().cancel()
+
+    def __resolve(self, inner: Future) -> None:
+        if inner.cancelled():
+            super().cancel()
+            return
+        self.set_running_or_notify_cancel()
+        exc = inner.exception()
+        if exc is not None:
+            self.set_exception(exc)
+            return
+        ok, value, duration = inner.result()
+        if self.entry is not None:
+            self.entry.add_fanout(duration)
+        if ok:
+            self.set_result(value)
+        else:
+            self.set_exception(value)
+
+
+class StacklogExecutor(Executor):
+    """Executor that carries the current stacklog block into its workers
+
+    Wraps a ``ThreadPoolExecutor`` or ``ProcessPoolExecutor``. The time each
+    submitted call takes to run is added to the fan-out time of the block
+    that was open when it was submitted, unless the block has exited by the
+    time the call finishes. In thread pools, blocks opened by
+    the call are also nested in that block. In process pools, blocks opened
+    by the call cannot refer to blocks in the parent process, so only the
+    fan-out time is carried over.
+
+    Example usage::
+
+       with stacktime(logging.info, 'Processing'):
+           with StacklogExecutor(ThreadPoolExecutor()) as executor:
+               list(executor.map(process, items))
+
+    Args:
+        executor: the executor to submit calls to
+    """
+
+    def __init__(self, executor: Executor):
+        self.executor = executor
+
+    def submit(self, fn, /, *args, **kwargs):  # type: ignore
+        if isinstance(self.executor, ThreadPoolExecutor):
+            return self.executor.submit(bind(fn), *args, **kwargs)
+        inner = self.executor.submit(timed_call, fn, *args, **kwargs)
+        return TimedFuture(inner, current_entry())
+
+    def shutdown(self, wait: bool = True, **kwargs: Any) -> None:
+        self.executor.shutdown(wait=wait, **kwargs)
@@ -0,0 +1,186 @@
+import cProfile
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+
+from .compat import Dict, List, Union
+
+logger = logging.getLogger(__name__)
+
+
+class CProfileRecorder:
+    """Record a deterministic profile of the current thread with cProfile
+
+    The profile is written in pstats format, which can be read with the
+    ``pstats`` module or converted to a flame graph with tools such as
+    ``flameprof`` or ``snakeviz``. cProfile slows down the profiled code
+    considerably, so this is meant for blocks that are already suspect.
+    """
+
+    extension = ".prof"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.running = False
+
+    def start(self) -> None:
+        try:
+            self.profile.enable()
+        except ValueError:
+            # another profiler is already active (python 3.12+)
+            return
+        self.running = True
+
+    def stop(self) -> None:
+        if self.running:
+            self.profile.disable()
+
+    def write(self, path: str) -> None:
+        self.profile.dump_stats(path)
+
+
+class SamplerThread:
+    """Shared background thread that samples the stacks of profiled threads
+
+    The thread is started the first time a sampler is added and waits
+    without waking up while no blocks are being profiled, so starting and
+    stopping a :class:`StackSampler` only costs a lock and a list update.
+
+    Args:
+        interval (float): seconds between samples. Defaults to 1 ms.
+    """
+
+    def __init__(self, interval: float = 1e-3):
+        self.interval = interval
+        self.__samplers: List["StackSampler"] = []
+        self.__condition = threading.Condition()
+        self.__thread: Union[threading.Thread, None] = None
+
+    def add(self, sampler: "StackSampler") -> None:
+        with self.__condition:
+            self.__samplers.append(sampler)
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__run, name="stacklog-sampler", daemon=True
+                )
+                self.__thread.start()
+            self.__condition.notify()
+
+    def __len__(self) -> int:
+        return len(self.__samplers)
+
+    def remove(self, sampler: "StackSampler") -> None:
+        # samples are taken while holding the lock, so once this returns the
+        # sampler's counts no longer change
+        with self.__condition:
+            self.__samplers.remove(sampler)
+
+    def reset(self) -> None:
+        """Forget the background thread and samplers, such as after a fork"""
+        self.__samplers = []
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while not self.__samplers:
+                    self.__condition.wait()
+                frames = sys._current_frames()
+                stacks: Dict[int, str] = {}
+                for sampler in self.__samplers:
+                    target = sampler.thread_id
+                    if target not in stacks:
+                        stacks[target] = collapse(frames.get(target))
+                    if stacks[target]:
+                        sampler.counts[stacks[target]] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+sampler_thread = SamplerThread()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=sampler_thread.reset)
+
+
+class StackSampler:
+    """Sample the call stack of the current thread from a shared background thread
+
+    The profile is written in collapsed-stack format (one ``frame;frame;frame
+    count`` line per distinct stack), which is the input format of
+    ``flamegraph.pl`` and speedscope. The profiled thread runs at full speed.
+    """
+
+    extension = ".collapsed"
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.thread_id: Union[int, None] = None
+        self.running = False
+
+    def start(self) -> None:
+        self.thread_id = threading.get_ident()
+        sampler_thread.add(self)
+        self.running = True
+
+    def stop(self) -> None:
+        if self.running:
+            sampler_thread.remove(self)
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write("%s %d\n" % (stack, count))
+
+
+def collapse(frame: Union[FrameType, None]) -> str:
+    """Return the stack ending at ``frame`` as ``;``-separated frames, root first"""
+    frames: List[str] = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        frames.append("%s@%s:%d" % (code.co_name, filename, code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(frames)).replace(" ", "_")
+
+
+PROFILERS = {
+    "collapsed": StackSampler,
+    "pstats": CProfileRecorder,
+}
+
+
+def make_profiler(profile_format: str) -> Union[CProfileRecorder, StackSampler]:
+    return PROFILERS[profile_format]()
+
+
+def make_profile_path(directory: str, message: str, extension: str) -> str:
+    slug = re.sub(r"[^\w.-]+", "_", message).strip("_")[:64] or "block"
+    stamp = time.strftime("%Y%m%dT%H%M%S")
+    name = "%s-%s-%d-%d%s" % (slug, stamp, os.getpid(), time.perf_counter_ns(), extension)
+    return os.path.join(directory, name)
+
+
+def write_profile(
+    profiler: Union[CProfileRecorder, StackSampler], directory: str, message: str
+) -> Union[str, None]:
+    """Write the profile to a new file in ``directory`` and return its path
+
+    Errors are logged rather than raised, so that they don't replace the
+    outcome of the profiled block. Returns None if the profile could not be
+    written.
+    """
+    path = make_profile_path(directory, message, profiler.extension)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        profiler.write(path)
+    except Exception:
+        logger.exception("Failed to write stacklog profile to %s", path)
+        return None
+    return path
@@ -0,0 +1,208 @@
+import json
+import logging
+import signal
+import threading
+from fnmatch import fnmatchcase
+from functools import partial
+from typing import Any, Callable
+
+from ._time_formatters import TIME_FORMATTERS
+from .compat import Dict, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class Settings:
+    """Runtime settings of a stacklog block
+
+    Args:
+        enabled (bool): whether the block logs at all. Disabled blocks run
+            their body without any logging or timing. Defaults to True.
+        level (int or str): logging level to log at, such as ``'DEBUG'``.
+            Only applies to blocks that log with a function from the
+            ``logging`` module or with a method of a ``logging.Logger``.
+            Defaults to None (keep the block's log method).
+        unit (str): time unit for blocks that log timing information, one of
+            'auto', 'ns', 'mks', 'ms', 's', 'min'. Defaults to None (keep the
+            block's unit).
+        sample (float): fraction of executions of the block that are logged.
+            Defaults to 1.0 (log every execution).
+        timing (bool): whether to add timing information to the success
+            message of plain stacklog blocks. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        enabled: Union[bool, None] = None,
+        level: Union[int, str, None] = None,
+        unit: Union[str, None] = None,
+        sample: Union[float, None] = None,
+        timing: Union[bool, None] = None,
+    ):
+        if unit is not None and unit not in TIME_FORMATTERS:
+            raise ValueError("Invalid unit: %r" % unit)
+        if sample is not None and not 0 <= sample <= 1:
+            raise ValueError("Invalid sample: %r" % sample)
+        if isinstance(level, str):
+            levelno = logging.getLevelName(level.upper())
+            if not isinstance(levelno, int):
+                raise ValueError("Invalid level: %r" % level)
+            level = levelno
+
+        self.enabled = enabled
+        self.level = level
+        self.unit = unit
+        self.sample = sample
+        self.timing = timing
+
+    def update(self, other: "Settings") -> None:
+        """Override these settings with the settings given in ``other``"""
+        for name, value in vars(other).items():
+            if value is not None:
+                setattr(self, name, value)
+
+
+DEFAULT_SETTINGS = Settings(enabled=True, sample=1.0, timing=False)
+
+
+class Registry:
+    """Registry of runtime settings for stacklog blocks
+
+    Settings are registered for blocks whose message and module (the module
+    in which the block was created) match the given glob-style patterns. When
+    several rules match a block, later rules take precedence.
+
+    Resolved settings are cached by message and module until the registry
+    changes, so matching is done once per call site, even for blocks that are
+    created anew on every execution.
+
+    Example usage::
+
+       from stacklog import registry
+
+       registry.configure('Polling*', enabled=False)
+       registry.configure('*', module='myapp.db.*', level='DEBUG', unit='ms')
+    """
+
+    __rules: List[Tuple[str, str, Settings]]
+
+    def __init__(self):
+        self.__rules = []
+        self.__cache: Dict[Tuple[str, str], Settings] = {}
+        self.__lock = threading.Lock()
+        self.version = 0
+
+    def configure(self, message: str = "*", module: str = "*", **settings: Any) -> None:
+        """Add settings for blocks matching ``message`` and ``module``
+
+        See :class:`Settings` for the available settings.
+        """
+        rule = (message, module, Settings(**settings))
+        with self.__lock:
+            self.__rules = self.__rules + [rule]
+            self.__cache = {}
+            self.version += 1
+
+    def clear(self) -> None:
+        """Remove all settings"""
+        with self.__lock:
+            self.__rules = []
+            self.__cache = {}
+            self.version += 1
+
+    def load(self, path: str) -> None:
+        """Replace all settings with those in the JSON file at ``path``
+
+        The file contains a list of objects with optional keys ``message``
+        and ``module`` (the patterns) and any of the settings, such as::
+
+           [
+             {"message": "Polling*", "enabled": false},
+             {"module": "myapp.db.*", "level": "DEBUG", "unit": "ms"}
+           ]
+        """
+        with open(path) as f:
+            entries: List[Dict[str, Any]] = json.load(f)
+
+        rules = []
+        for entry in entries:
+            entry = dict(entry)
+            message = entry.pop("message", "*")
+            module = entry.pop("module", "*")
+            rules.append((message, module, Settings(**entry)))
+
+        with self.__lock:
+            self.__rules = rules
+            self.__cache = {}
+            self.version += 1
+
+    def reload(self, path: str) -> bool:
+        """Like :meth:`load`, but log errors and keep the current settings
+
+        Returns whether the settings were reloaded.
+        """
+        try:
+            self.load(path)
+        except Exception:
+            logger.exception("Failed to reload stacklog settings from %s", path)
+            return False
+        return True
+
+    def install_signal_handler(self, path: str, signum: Union[int, None] = None) -> None:
+        """Reload settings from ``path`` whenever the process receives ``signum``
+
+        Defaults to ``SIGHUP``. Like ``signal.signal``, this must be called
+        from the main thread. The settings are reloaded with :meth:`reload`
+        on a separate thread, so that errors in the file are logged instead
+        of being raised in whatever code the signal interrupts, and so that a
+        signal that arrives while the registry is being changed does not
+        deadlock.
+        """
+        if signum is None:
+            signum = signal.SIGHUP
+
+        def handler(_signum, _frame):
+            threading.Thread(
+                target=self.reload, args=(path,), name="stacklog-reload", daemon=True
+            ).start()
+
+        signal.signal(signum, handler)
+
+    def lookup(self, message: str, module: str) -> Settings:
+        """Return the cached settings for a block with the given message and module"""
+        cache = self.__cache
+        key = (message, module)
+        settings = cache.get(key)
+        if settings is None:
+            settings = cache[key] = self.resolve(message, module)
+        return settings
+
+    def resolve(self, message: str, module: str) -> Settings:
+        """Return the settings for a block with the given message and module"""
+        settings = None
+        for message_pattern, module_pattern, rule in self.__rules:
+            if fnmatchcase(message, message_pattern) and fnmatchcase(module, module_pattern):
+                if settings is None:
+                    settings = Settings()
+                    settings.update(DEFAULT_SETTINGS)
+                settings.update(rule)
+        if settings is None:
+            return DEFAULT_SETTINGS
+        return settings
+
+
+def with_level(method: Callable[..., Any], level: int) -> Callable[..., Any]:
+    """Return a log method like ``method`` that logs at ``level``
+
+    Methods that do not come from the ``logging`` module are returned
+    unchanged.
+    """
+    owner = getattr(method, "__self__", None)
+    if isinstance(owner, logging.Logger):
+        return partial(owner.log, level)
+    if getattr(method, "__module__", None) == logging.__name__:
+        return partial(logging.log, level)
+    return method
+
+
+registry = Registry()
@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from .compat import List, Union
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Run callbacks at given times on a single shared background thread
+
+    The thread is started the first time a callback is scheduled and sleeps
+    until the earliest deadline. Scheduled callbacks can be cancelled, which
+    drops the reference to the callback right away. Cancelled callbacks are
+    removed from the queue once they reach its head or once they make up half
+    of it, so the queue stays proportional to the callbacks that are pending.
+    """
+
+    def __init__(self):
+        # items are [deadline, seq, func], with func set to None on cancel
+        self.__queue: List[List[Any]] = []
+        self.__cancelled = 0
+        self.__counter = itertools.count()
+        self.__condition = threading.Condition()
+        self.__thread: Union[threading.Thread, None] = None
+
+    def __len__(self) -> int:
+        return len(self.__queue)
+
+    def schedule(self, deadline: float, func: Callable[[], Any]) -> List[Any]:
+        """Call ``func`` once ``time.perf_counter()`` reaches ``deadline``
+
+        Returns a handle that can be passed to :meth:`cancel`.
+        """
+        with self.__condition:
+            item = [deadline, next(self.__counter), func]
+            heapq.heappush(self.__queue, item)
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__run, name="stacklog-scheduler", daemon=True
+                )
+                self.__thread.start()
+            elif self.__queue[0] is item:
+                self.__condition.notify()
+            return item
+
+    def cancel(self, item: List[Any]) -> None:
+        """Cancel a callback, if it has not run yet"""
+        with self.__condition:
+            if item[2] is None:
+                return
+            item[2] = None
+            self.__cancelled += 1
+            queue = self.__queue
+            while queue and queue[0][2] is None:
+                heapq.heappop(queue)
+                self.__cancelled -= 1
+            if self.__cancelled * 2 > len(queue):
+                self.__queue = [i for i in queue if i[2] is not None]
+                heapq.heapify(self.__queue)
+                self.__cancelled = 0
+
+    def reset(self) -> None:
+        """Forget the background thread and pending callbacks, such as after a fork"""
+        self.__queue = []
+        self.__cancelled = 0
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while self.__queue and self.__queue[0][2] is None:
+                    heapq.heappop(self.__queue)
+                    self.__cancelled -= 1
+                if not self.__queue:
+                    self.__condition.wait()
+                    continue
+                delay = self.__queue[0][0] - time.perf_counter()
+                if delay > 0:
+                    self.__condition.wait(delay)
+                    continue
+                item = heapq.heappop(self.__queue)
+                func, item[2] = item[2], None
+                if func is None:
+                    self.__cancelled -= 1
+                    continue
+            try:
+                func()
+            except Exception:
+                logger.exception("Error in scheduled stacklog callback")
+
+
+scheduler = Scheduler()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=scheduler.reset)
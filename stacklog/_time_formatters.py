@@ -1,3 +1,8 @@
+import re
+
+from .compat import Union
+
+
 def s2ns(sec: float) -> str:
     return "%8.2f ns" % (sec * 1e9)
 
@@ -43,3 +48,27 @@ TIME_FORMATTERS = {
 
 def format_time(unit: str, sec: float) -> str:
     return TIME_FORMATTERS[unit](sec).lstrip()
+
+
+TIME_UNITS = {
+    "": 1,
+    "ns": 1e-9,
+    "mks": 1e-6,
+    "us": 1e-6,
+    "ms": 1e-3,
+    "s": 1,
+    "min": 60,
+}
+
+
+def parse_time(value: Union[float, str]) -> float:
+    """Parse a duration such as ``'50ms'`` or ``'1.5 s'`` into seconds
+
+    Numbers are taken to be in seconds already.
+    """
+    if not isinstance(value, str):
+        return float(value)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?(?:e[-+]?\d+)?)\s*([a-z]*)\s*", value)
+    if match is None or match.group(2) not in TIME_UNITS:
+        raise ValueError("Invalid duration: %r" % value)
+    return float(match.group(1)) * TIME_UNITS[match.group(2)]
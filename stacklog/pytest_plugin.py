@@ -0,0 +1,223 @@
+"""pytest plugin to check stacktime blocks against budgets and baselines
+
+The plugin is installed with stacklog and does nothing unless enabled with
+one of its options:
+
+- ``--stacklog-budgets``: fail tests in which a stacktime block takes longer
+  than its ``budget``.
+- ``--stacklog-baseline=PATH``: fail tests in which the median duration of a
+  stacktime block has regressed compared to the baseline file at ``PATH``.
+- ``--stacklog-update-baseline``: record the durations of this run in the
+  baseline file instead of checking them.
+
+Blocks are identified by the test they run in and their message. A block is
+considered to have regressed if its median duration exceeds the baseline
+median by more than ``--stacklog-tolerance`` times the baseline's (scaled)
+median absolute deviation, and by more than ``--stacklog-min-slowdown``
+relative to the baseline median. Use ``--stacklog-rounds`` to run each test
+several times and get more stable medians.
+
+Extra rounds call the test function again with the same fixture values; the
+fixtures are not set up anew. Tests that are not idempotent, such as tests
+that create a file in ``tmp_path``, can fail in the extra rounds. Such
+failures do not fail the test: the plugin issues a
+:class:`StacklogRoundsWarning` and uses the rounds that completed.
+"""
+
+import json
+import os
+import statistics
+import warnings
+from typing import Any
+
+import pytest
+
+from . import stacktime
+from ._time_formatters import format_time
+from .compat import Dict, List, Union
+
+# scales the MAD to be comparable to the standard deviation of normal data
+MAD_SCALE = 1.4826
+
+
+class StacklogRegressionWarning(UserWarning):
+    """A stacktime block is slower than its baseline"""
+
+
+class StacklogRoundsWarning(UserWarning):
+    """An extra round of a test failed, so fewer durations were collected"""
+
+
+def pytest_addoption(parser: Any) -> None:
+    group = parser.getgroup("stacklog", "stacktime budgets and baselines")
+    group.addoption(
+        "--stacklog-budgets",
+        action="store_true",
+        help="fail tests in which a stacktime block exceeds its budget",
+    )
+    group.addoption(
+        "--stacklog-baseline",
+        metavar="PATH",
+        help="compare stacktime durations against the baseline file at PATH",
+    )
+    group.addoption(
+        "--stacklog-update-baseline",
+        action="store_true",
+        help="write stacktime durations to the baseline file instead of comparing them",
+    )
+    group.addoption(
+        "--stacklog-rounds",
+        type=int,
+        default=1,
+        metavar="N",
+        help="run each test function N times, reusing its fixtures, to collect stacktime "
+        "durations (default: 1)",
+    )
+    group.addoption(
+        "--stacklog-tolerance",
+        type=float,
+        default=3.0,
+        metavar="K",
+        help="allowed slowdown in baseline MADs before a regression (default: 3)",
+    )
+    group.addoption(
+        "--stacklog-min-slowdown",
+        type=float,
+        default=0.1,
+        metavar="FRACTION",
+        help="allowed slowdown relative to the baseline median (default: 0.1)",
+    )
+    group.addoption(
+        "--stacklog-warn-only",
+        action="store_true",
+        help="warn about regressions instead of failing tests",
+    )
+
+
+def pytest_configure(config: Any) -> None:
+    if config.getoption("stacklog_update_baseline") and not config.getoption("stacklog_baseline"):
+        raise pytest.UsageError("--stacklog-update-baseline requires --stacklog-baseline")
+    if config.getoption("stacklog_budgets") or config.getoption("stacklog_baseline"):
+        config.pluginmanager.register(StacklogPlugin(config), "stacklog-checks")
+
+
+def summarize(durations: List[float]) -> Dict[str, Any]:
+    """Return the median, median absolute deviation and count of durations"""
+    median = statistics.median(durations)
+    mad = statistics.median(abs(d - median) for d in durations)
+    return {"median": median, "mad": mad, "n": len(durations)}
+
+
+class StacklogPlugin:
+    """Collect stacktime durations per test and check them"""
+
+    def __init__(self, config: Any):
+        self.budgets = config.getoption("stacklog_budgets")
+        self.baseline_path = config.getoption("stacklog_baseline")
+        self.update = config.getoption("stacklog_update_baseline")
+        self.rounds = max(config.getoption("stacklog_rounds"), 1)
+        self.tolerance = config.getoption("stacklog_tolerance")
+        self.min_slowdown = config.getoption("stacklog_min_slowdown")
+        self.warn_only = config.getoption("stacklog_warn_only")
+
+        self.baseline: Dict[str, Dict[str, Any]] = {}
+        if self.baseline_path and os.path.exists(self.baseline_path):
+            with open(self.baseline_path) as f:
+                self.baseline = json.load(f)
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.failures: Dict[str, List[str]] = {}
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item: Any):
+        durations: Dict[str, List[float]] = {}
+        over_budget: List[str] = []
+
+        def observe(block: stacktime) -> None:
+            durations.setdefault(block.message, []).append(block.wall_seconds)
+            if block.over_budget:
+                unit = block.settings.unit or block.unit
+                budget = format_time(unit, block.budget)  # type: ignore
+                over_budget.append(
+                    "%s: took %s, over budget of %s" % (block.message, block.elapsed, budget)
+                )
+
+        stacktime.observers.append(observe)
+        try:
+            outcome = yield
+            if outcome.excinfo is None:
+                self.run_extra_rounds(item)
+        finally:
+            stacktime.observers.remove(observe)
+
+        if outcome.excinfo is not None:
+            return
+
+        regressions = []
+        for message, samples in durations.items():
+            key = item.nodeid + "::" + message
+            result = summarize(samples)
+            self.results[key] = result
+            if not self.update and key in self.baseline:
+                regression = self.check_regression(message, result, self.baseline[key])
+                if regression is not None:
+                    regressions.append(regression)
+
+        if regressions and self.warn_only:
+            for regression in regressions:
+                warnings.warn(StacklogRegressionWarning(regression))
+            regressions = []
+
+        failures = (over_budget if self.budgets else []) + regressions
+        if failures:
+            self.failures[item.nodeid] = failures
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item: Any, call: Any):
+        outcome = yield
+        if call.when != "call":
+            return
+        failures = self.failures.pop(item.nodeid, None)
+        report = outcome.get_result()
+        if failures and report.passed:
+            report.outcome = "failed"
+            report.longrepr = "\n".join(failures)
+
+    def run_extra_rounds(self, item: Any) -> None:
+        """Run the test function again, stopping at the first failure"""
+        for i in range(1, self.rounds):
+            try:
+                item.runtest()
+            except Exception as e:
+                warnings.warn(
+                    StacklogRoundsWarning(
+                        "round %d of %d failed with %r; using durations from %d rounds"
+                        % (i + 1, self.rounds, e, i)
+                    )
+                )
+                return
+
+    def check_regression(
+        self, message: str, result: Dict[str, Any], baseline: Dict[str, Any]
+    ) -> Union[str, None]:
+        """Return a description of the regression of ``result``, if any"""
+        median, base_median = result["median"], baseline["median"]
+        threshold = base_median + max(
+            self.tolerance * MAD_SCALE * baseline["mad"], self.min_slowdown * base_median
+        )
+        if median <= threshold:
+            return None
+        return "%s: median %s regressed from baseline %s (threshold %s)" % (
+            message,
+            format_time("auto", median),
+            format_time("auto", base_median),
+            format_time("auto", threshold),
+        )
+
+    def pytest_sessionfinish(self, session: Any) -> None:
+        if not self.update:
+            return
+        baseline = dict(self.baseline)
+        baseline.update(self.results)
+        with open(self.baseline_path, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
@@ -5,13 +5,30 @@
 
 from __future__ import print_function
 
+import json
 import logging
+import os
 import re
+import signal
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import pytest
 
-from stacklog import stacklog, stacktime
+from stacklog import StacklogExecutor, registry, stacklog, stacktime
+from stacklog._profiling import sampler_thread
+from stacklog._scheduler import scheduler
+
+pytest_plugins = ["pytester"]
+
+PLUGIN_ARGS = ["-p", "no:stacklog", "-p", "stacklog.pytest_plugin"]
+
+
+@pytest.fixture
+def clean_registry():
+    yield registry
+    registry.clear()
 
 
 def test_logs_success(caplog):
@@ -82,3 +99,477 @@ def test_stacktime(capsys):
     actual = capsys.readouterr().out.split("\n")
     for e, a in zip(expected, actual):
         assert re.match(e, a)
+
+
+def test_defer_merges_begin_and_end(caplog):
+    """With defer, a fast block logs a single combined line"""
+    msg = "Running"
+
+    with stacklog(logging.critical, msg, defer=60):
+        pass
+
+    expected = ["Running...DONE"]
+    actual = caplog.messages
+    assert actual == expected
+
+
+def test_defer_logs_begin_when_overdue(caplog):
+    """With defer, a block that runs longer than the delay logs both lines"""
+    msg = "Running"
+
+    with stacklog(logging.critical, msg, defer=0):
+        pass
+
+    expected = ["Running...", "Running...DONE"]
+    actual = caplog.messages
+    assert actual == expected
+
+
+def test_defer_logs_begin_while_open():
+    """With defer, the begin line is written once the delay expires"""
+    lines = []
+
+    with stacklog(lines.append, "Running", defer=1e-2):
+        deadline = time.time() + 5
+        while not lines and time.time() < deadline:
+            time.sleep(1e-3)
+        assert lines == ["Running..."]
+
+    assert lines == ["Running...", "Running...DONE"]
+
+
+def test_defer_cancels_release_on_exit():
+    """With defer, fast blocks leave nothing pending in the scheduler"""
+    for _ in range(1000):
+        with stacklog(lambda _: None, "Running", defer=3600):
+            pass
+
+    assert len(scheduler) == 0
+
+
+def test_defer_logs_begin_before_nested(caplog):
+    """With defer, the begin line is released when a nested block logs"""
+    with stacklog(logging.critical, "Outer", defer=60):
+        with stacklog(logging.critical, "Inner", defer=60):
+            pass
+
+    expected = ["Outer...", "Inner...DONE", "Outer...DONE"]
+    actual = caplog.messages
+    assert actual == expected
+
+
+def test_stacktime_defer(capsys):
+    msg = "Running"
+
+    with stacktime(print, msg, unit="ms", defer=60):
+        pass
+
+    actual = capsys.readouterr().out.splitlines()
+    assert len(actual) == 1
+    assert re.match(r"Running...DONE in [\d.]+ ms", actual[0])
+
+
+def test_stacktime_recursive():
+    """Recursive executions of a decorated stacktime are timed separately"""
+    durations = []
+
+    def observe(block):
+        durations.append((block.elapsed_seconds, block.over_budget))
+
+    @stacktime(lambda _: None, "Rec", budget="50ms")
+    def rec(n):
+        time.sleep(1e-2)
+        if n:
+            rec(n - 1)
+        time.sleep(1e-2)
+
+    stacktime.observers.append(observe)
+    try:
+        rec(3)
+    finally:
+        stacktime.observers.remove(observe)
+
+    elapsed = [d for d, _ in durations]
+    assert elapsed == sorted(elapsed)
+    assert elapsed[-1] >= 8e-2
+    assert [b for _, b in durations] == [False, False, True, True]
+
+
+@pytest.mark.parametrize("profile_format", ["pstats", "collapsed"])
+def test_stacktime_profile(capsys, tmp_path, profile_format):
+    """Blocks over the profile threshold write a profile"""
+    msg = "Running"
+
+    kwargs = dict(profile=0, profile_dir=str(tmp_path), profile_format=profile_format)
+    with stacktime(print, msg, **kwargs):
+        time.sleep(1e-2)
+
+    actual = capsys.readouterr().out.splitlines()
+    assert re.match(r"Running...DONE in .+ \(profile: .+\)", actual[-1])
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_stacktime_profile_failure(capsys, tmp_path):
+    """Failed blocks over the profile threshold report their profile"""
+    with pytest.raises(ValueError):
+        with stacktime(print, "Running", profile=0, profile_dir=str(tmp_path)):
+            raise ValueError
+
+    actual = capsys.readouterr().out.splitlines()
+    assert re.match(r"Running...FAILURE \(profile: .+\.collapsed\)", actual[-1])
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_stacktime_profile_creates_dir(capsys, tmp_path):
+    """Profiles are written to a new directory if needed"""
+    profile_dir = tmp_path / "profiles"
+
+    with stacktime(print, "Running", profile=0, profile_dir=str(profile_dir)):
+        pass
+
+    actual = capsys.readouterr().out.splitlines()
+    assert re.match(r"Running...DONE in .+ \(profile: .+\)", actual[-1])
+    assert len(list(profile_dir.iterdir())) == 1
+
+
+def test_stacktime_profile_write_error(capsys, caplog, tmp_path):
+    """Errors writing profiles are logged and don't replace the block's outcome"""
+    not_a_dir = tmp_path / "file"
+    not_a_dir.write_text("")
+
+    with stacktime(print, "Running", profile=0, profile_dir=str(not_a_dir)):
+        pass
+    with pytest.raises(ValueError):
+        with stacktime(print, "Running", profile=0, profile_dir=str(not_a_dir)):
+            raise ValueError
+
+    actual = capsys.readouterr().out.splitlines()
+    assert re.match(r"Running...DONE in [\d.]+ \w+$", actual[1])
+    assert actual[-1] == "Running...FAILURE"
+    assert caplog.text.count("Failed to write stacklog profile") == 2
+
+
+def test_stacktime_profile_recursive(tmp_path):
+    """Recursive executions of a profiled block each stop their own sampler"""
+
+    @stacktime(lambda _: None, "Running", profile=60, profile_dir=str(tmp_path))
+    def rec(n):
+        if n:
+            rec(n - 1)
+
+    rec(3)
+
+    assert len(sampler_thread) == 0
+
+
+def test_stacktime_profile_threads(tmp_path):
+    """Concurrent executions of a profiled block each stop their own sampler"""
+    barrier = threading.Barrier(4)
+
+    @stacktime(lambda _: None, "Running", profile=60, profile_dir=str(tmp_path))
+    def run():
+        barrier.wait()
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sampler_thread) == 0
+
+
+def test_stacktime_profile_fast(tmp_path):
+    """Blocks under the profile threshold do not write a profile"""
+    with stacktime(lambda _: None, "Running", profile=60, profile_dir=str(tmp_path)):
+        pass
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_registry_disable(caplog, clean_registry):
+    """Disabled blocks run without logging"""
+    clean_registry.configure("Running*", module=__name__, enabled=False)
+    calls = []
+
+    @stacklog(logging.critical, "Running")
+    def run():
+        calls.append(None)
+
+    run()
+    with stacklog(logging.critical, "Running too"):
+        calls.append(None)
+    with stacklog(logging.critical, "Other"):
+        calls.append(None)
+
+    assert len(calls) == 3
+    assert caplog.messages == ["Other...", "Other...DONE"]
+
+
+def test_registry_updates_cached_settings(caplog, clean_registry):
+    """Blocks pick up registry changes made after they were created"""
+    s = stacklog(logging.critical, "Running")
+
+    clean_registry.configure("Running", enabled=False)
+    with s:
+        pass
+    clean_registry.clear()
+    with s:
+        pass
+
+    assert caplog.messages == ["Running...", "Running...DONE"]
+
+
+def test_registry_level(caplog, clean_registry):
+    """The registry can change the level of logging blocks"""
+    clean_registry.configure("Running", level="WARNING")
+    logger = logging.getLogger(__name__)
+
+    with stacklog(logger.critical, "Running"):
+        pass
+
+    assert [r.levelno for r in caplog.records] == [logging.WARNING, logging.WARNING]
+
+
+def test_registry_unit_and_timing(capsys, clean_registry):
+    """The registry can change the unit of stacktime and add timing to stacklog"""
+    clean_registry.configure("Running", unit="ns", timing=True)
+
+    with stacktime(print, "Running", unit="s"):
+        pass
+    with stacklog(print, "Running"):
+        pass
+
+    actual = capsys.readouterr().out.splitlines()
+    assert re.match(r"Running...DONE in [\d.]+ ns", actual[1])
+    assert re.match(r"Running...DONE in [\d.]+ ns", actual[3])
+
+
+def test_registry_load(caplog, clean_registry, tmp_path):
+    """Settings can be loaded from a JSON file"""
+    path = tmp_path / "stacklog.json"
+    path.write_text(json.dumps([{"message": "Running", "sample": 0}]))
+    clean_registry.load(str(path))
+
+    with stacklog(logging.critical, "Running"):
+        pass
+
+    assert caplog.messages == []
+
+
+def test_stacktime_budget(capsys):
+    """Blocks that take longer than their budget are reported"""
+    with stacktime(print, "Running", unit="ms", budget="1ms") as s:
+        time.sleep(1e-2)
+
+    assert s.over_budget
+    actual = capsys.readouterr().out.splitlines()
+    assert re.match(r"Running...DONE in [\d.]+ ms \(over budget of 1.00 ms\)", actual[-1])
+
+
+def test_plugin_budgets(pytester):
+    """With --stacklog-budgets, tests with blocks over budget fail"""
+    pytester.makepyfile(
+        """
+        import time
+        from stacklog import stacktime
+
+        def test_slow():
+            with stacktime(print, "Running", budget=1e-3):
+                time.sleep(1e-2)
+        """
+    )
+
+    assert pytester.runpytest(*PLUGIN_ARGS).ret == 0
+    result = pytester.runpytest("--stacklog-budgets", *PLUGIN_ARGS)
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["*Running: took *, over budget of 1.00 ms*"])
+    result.stdout.no_fnmatch_line("*PluggyTeardownRaisedWarning*")
+
+
+def test_plugin_baseline(pytester, monkeypatch):
+    """With --stacklog-baseline, tests with regressed blocks fail"""
+    pytester.makepyfile(
+        """
+        import os
+        import time
+        from stacklog import stacktime
+
+        def test_timed():
+            with stacktime(print, "Running"):
+                time.sleep(float(os.environ["STACKLOG_TEST_SLEEP"]))
+        """
+    )
+    baseline = str(pytester.path / "baseline.json")
+    args = ["--stacklog-baseline", baseline, "--stacklog-rounds", "3"] + PLUGIN_ARGS
+
+    monkeypatch.setenv("STACKLOG_TEST_SLEEP", "0.001")
+    pytester.runpytest("--stacklog-update-baseline", *args).assert_outcomes(passed=1)
+    with open(baseline) as f:
+        assert list(json.load(f)) == ["test_plugin_baseline.py::test_timed::Running"]
+
+    monkeypatch.setenv("STACKLOG_TEST_SLEEP", "0.05")
+    result = pytester.runpytest(*args)
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["*Running: median * regressed from baseline *"])
+
+    result = pytester.runpytest("--stacklog-warn-only", *args)
+    result.assert_outcomes(passed=1, warnings=1)
+
+
+def test_bind(capsys):
+    """Bound functions attach their blocks and time to the current block"""
+    parents = []
+
+    def work():
+        with stacklog(lambda _: None, "Working") as s:
+            parents.append(s.parent)
+        time.sleep(1e-2)
+
+    with stacktime(print, "Running", unit="ms") as outer:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for _ in range(4):
+                executor.submit(stacklog.bind(work))
+
+    assert parents == [outer] * 4
+    assert outer.fanout_seconds >= 4e-2
+    actual = capsys.readouterr().out.splitlines()
+    assert re.match(r"Running...DONE in [\d.]+ ms \(fan-out [\d.]+ ms\)", actual[-1])
+
+
+@pytest.mark.parametrize("executor_type", [ThreadPoolExecutor, ProcessPoolExecutor])
+def test_stacklog_executor(executor_type):
+    """Time spent in executor workers is added to the current block"""
+    with stacklog(lambda _: None, "Running") as outer:
+        with StacklogExecutor(executor_type(max_workers=2)) as executor:
+            results = list(executor.map(time.sleep, [1e-2] * 4))
+
+    assert results == [None] * 4
+    assert outer.fanout_seconds >= 4e-2
+    assert stacklog.current() is None
+
+
+def test_stacklog_executor_exception():
+    """Exceptions raised in process workers are passed on"""
+    with stacklog(lambda _: None, "Running"):
+        with StacklogExecutor(ProcessPoolExecutor(max_workers=1)) as executor:
+            future = executor.submit(time.sleep, "not a number")
+            with pytest.raises(TypeError):
+                future.result()
+
+
+def test_registry_sample_recursive(caplog, clean_registry):
+    """Sampled executions of a shared instance keep the block stack balanced"""
+    clean_registry.configure("Rec", sample=0.5)
+
+    @stacklog(logging.critical, "Rec")
+    def rec(n):
+        if n:
+            rec(n - 1)
+
+    for _ in range(20):
+        rec(5)
+
+    assert stacklog.current() is None
+    with stacklog(logging.critical, "Other") as s:
+        assert s.parent is None
+    assert caplog.messages.count("Rec...") == caplog.messages.count("Rec...DONE")
+
+
+def test_bind_late_work():
+    """Work that finishes after its block has exited is not added to any block"""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with stacklog(lambda _: None, "Running") as s:
+            future = executor.submit(stacklog.bind(time.sleep), 2e-2)
+        assert s.fanout_seconds == 0
+
+        with s:
+            future.result()
+        assert s.fanout_seconds == 0
+
+
+def test_registry_caches_per_call_site(clean_registry, monkeypatch):
+    """Settings are resolved once per message and module, not once per instance"""
+    clean_registry.configure("Running", enabled=False)
+    calls = []
+    resolve = clean_registry.resolve
+    monkeypatch.setattr(clean_registry, "resolve", lambda *a: calls.append(a) or resolve(*a))
+
+    for _ in range(100):
+        with stacklog(logging.critical, "Running"):
+            pass
+
+    assert len(calls) == 1
+
+
+def test_registry_reload_keeps_settings_on_error(caplog, clean_registry, tmp_path):
+    """Reloading a bad settings file logs the error and keeps the current settings"""
+    clean_registry.configure("Running", enabled=False)
+    path = tmp_path / "stacklog.json"
+    path.write_text(json.dumps([{"message": "Running", "enabld": True}]))
+
+    assert not clean_registry.reload(str(path))
+    assert not clean_registry.lookup("Running", __name__).enabled
+    assert "Failed to reload stacklog settings" in caplog.text
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGHUP"), reason="requires SIGHUP")
+def test_registry_signal_handler(clean_registry, tmp_path):
+    """Signals reload settings in the background without raising errors"""
+    path = tmp_path / "stacklog.json"
+    path.write_text("not json")
+    previous = signal.getsignal(signal.SIGHUP)
+    clean_registry.install_signal_handler(str(path))
+    try:
+        os.kill(os.getpid(), signal.SIGHUP)
+        time.sleep(5e-2)
+
+        path.write_text(json.dumps([{"message": "Running", "enabled": False}]))
+        version = clean_registry.version
+        os.kill(os.getpid(), signal.SIGHUP)
+        deadline = time.time() + 5
+        while clean_registry.version == version and time.time() < deadline:
+            time.sleep(1e-3)
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+
+    assert not clean_registry.lookup("Running", __name__).enabled
+
+
+def test_plugin_rounds_not_idempotent(pytester):
+    """Failures in extra rounds are reported as warnings, not test failures"""
+    pytester.makepyfile(
+        """
+        from stacklog import stacktime
+
+        def test_mkdir(tmp_path):
+            with stacktime(print, "Running"):
+                (tmp_path / "out").mkdir()
+        """
+    )
+    baseline = str(pytester.path / "baseline.json")
+    args = ["--stacklog-baseline", baseline, "--stacklog-rounds", "3"] + PLUGIN_ARGS
+
+    result = pytester.runpytest(*args)
+    result.assert_outcomes(passed=1, warnings=1)
+    result.stdout.fnmatch_lines(["*round 2 of 3 failed with FileExistsError*"])
+
+
+@pytest.mark.parametrize("nested_in_other", [False, True])
+def test_registry_disabled_while_open(caplog, clean_registry, nested_in_other):
+    """Blocks disabled while an execution is open still exit that execution"""
+
+    @stacklog(logging.critical, "Rec")
+    def rec(n):
+        if n == 2:
+            clean_registry.configure("Rec", enabled=False)
+        if n and nested_in_other:
+            with stacklog(logging.critical, "Other"):
+                rec(n - 1)
+        elif n:
+            rec(n - 1)
+
+    rec(3)
+
+    assert stacklog.current() is None
+    assert caplog.messages.count("Rec...") == caplog.messages.count("Rec...DONE") == 2